@@ -9,6 +9,7 @@ KACER BOT — Final (normalize menu choices 01-09 -> 1-9, full features)
 - Forward semua user text langsung ke stdin tool (tanpa konfirmasi chat)
 - Hilangkan spam "✅ Input dikirim"
 - Multi-user sessions, per-user logs di ~/bot_logs/<user_id>.log
+- Pakai uvloop kalau terpasang (opsional, pip install 'uvloop>=0.18')
 """
 
 import asyncio
@@ -18,12 +19,16 @@ import re
 import signal
 import site
 import sys
+import time
+from collections import OrderedDict, deque
 from dataclasses import dataclass, field
-from typing import Dict, List, Optional, Tuple
+from functools import lru_cache
+from typing import Callable, Deque, Dict, List, Optional, Tuple, Union
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (
     Application,
+    CallbackContext,
     CallbackQueryHandler,
     CommandHandler,
     ContextTypes,
@@ -44,14 +49,27 @@ TOOLS_DIR = os.path.join(HOME_DIR, "me-cli")
 TOOLS_FILE = os.path.join(TOOLS_DIR, "main.py")
 
 BUFFER_FLUSH_IDLE = 5.0   # seconds
-TG_MAX = 3800
-
-MENU_ITEM_RE = re.compile(r"^\s*(\d+)\.\s*(.+)$")
-PROMPT_KEYWORDS_RE = re.compile(r"(?i)\b(pilih|enter|family|kode|otp|nomor|number|pin|masuk)\b")
-ENDS_WITH_COLON_RE = re.compile(r".+:\s*$")
-ONLY_DIGITS_RE = re.compile(r"^\d{1,8}$")
+READ_CHUNK = 1 << 16       # bytes per read from tool stdout
+STDOUT_LIMIT = 1 << 20     # StreamReader limit / longest unterminated line kept before it is forced out
+PROMPT_TAIL_MAX = 1024     # only the last this-many bytes of an unterminated line are checked for a prompt
+TG_MAX_BYTES = 3800       # chunk size in UTF-8 bytes (always <= Telegram's 4096-char limit)
+LABEL_CAP = 28            # menu button labels longer than this are truncated
+LABEL_TRUNC = 25          # ...to this many chars + '...'
+SEND_QUEUE_SIZE = 32      # pending outgoing messages per session
+LIST_CACHE_TTL = 1.0      # seconds the rendered session list is reused
+MAX_SESSIONS = 10_000     # idle sessions beyond this are evicted (LRU)
+SHUTDOWN_STOP_TIMEOUT = 5.0  # per-session limit for stopping tools on shutdown
+
+# line-level patterns run on raw bytes, so plain output lines are never decoded on the hot path
+MENU_ITEM_RE = re.compile(rb"^\s*(\d+)\.\s*(.+)$")
+PROMPT_KEYWORDS_RE = re.compile(rb"(?i)\b(pilih|enter|family|kode|otp|nomor|number|pin|masuk)\b")
+ENDS_WITH_COLON_RE = re.compile(rb".+:\s*$")
+ONLY_DIGITS_RE = re.compile(rb"^\d{1,8}$")
+AUTO_ENTER_RE = re.compile(rb"press (?:enter|any key) to continue", re.I)
+BACK_LABEL_RE = re.compile(r"kemb|utama|back", re.I)
 
 LOG_DIR = os.path.join(HOME_DIR, "bot_logs")
+LOG_DRAIN_INTERVAL = 0.2  # seconds between batched log writes
 os.makedirs(LOG_DIR, exist_ok=True)
 
 # -------------------------
@@ -64,49 +82,107 @@ class Session:
     proc: Optional[asyncio.subprocess.Process] = None
     stdin_writer: Optional[asyncio.StreamWriter] = None
 
-    partial: str = ""
-    buffer_lines: List[str] = field(default_factory=list)
+    buffer: bytearray = field(default_factory=bytearray)
     menu_items: List[Tuple[str, str]] = field(default_factory=list)
 
-    last_output_time: float = 0.0
     awaiting_input: bool = False
     last_prompt_time: Optional[float] = None
     input_prompt_text: Optional[str] = None
 
     reader_task: Optional[asyncio.Task] = None
-    flusher_task: Optional[asyncio.Task] = None
+    sender_task: Optional[asyncio.Task] = None
+    flush_handle: Optional[asyncio.TimerHandle] = None
+    flush_task: Optional[asyncio.Task] = None
 
-    send_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    send_queue: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(maxsize=SEND_QUEUE_SIZE))
     lock: asyncio.Lock = field(default_factory=asyncio.Lock)
 
+    # clock for prompt timestamps; bound to the running loop's time() in start_tool
+    _now: Callable[[], float] = field(default=time.monotonic, repr=False)
+
     def is_running(self) -> bool:
         return self.proc is not None and (self.proc.returncode is None)
 
-SESSIONS: Dict[int, Session] = {}
+SESSIONS: "OrderedDict[int, Session]" = OrderedDict()
+
+def get_session(user_id: int, chat_id: int) -> Session:
+    """
+    Get or create the user's session, keeping SESSIONS in LRU order.
+    When over MAX_SESSIONS, the least recently used idle session is dropped
+    (running sessions are never evicted).
+    """
+    s = SESSIONS.get(user_id)
+    if s is not None:
+        SESSIONS.move_to_end(user_id)
+        return s
+    s = SESSIONS[user_id] = Session(user_id=user_id, chat_id=chat_id)
+    if len(SESSIONS) > MAX_SESSIONS:
+        for uid, old in SESSIONS.items():
+            if uid != user_id and not old.is_running():
+                del SESSIONS[uid]
+                break
+    return s
+
+# last rendered "List Sessions" text: (loop time, text)
+_list_cache: Tuple[float, str] = (float("-inf"), "")
 
 # -------------------------
 # Helpers: logging, keyboards, sending
 # -------------------------
-def _log(session: Session, msg: str, tag: str = "INFO"):
-    try:
-        path = os.path.join(LOG_DIR, f"{session.user_id}.log")
-        with open(path, "a", encoding="utf-8") as f:
-            f.write(f"[{tag}] {msg}\n")
-    except Exception:
-        pass
+# pending log entries (user_id, tag, msg); written off the event loop by _log_drainer
+_LOG_QUEUE: Deque[Tuple[int, str, Union[str, bytes]]] = deque()
+_log_task: Optional[asyncio.Task] = None
+_log_stop: Optional[asyncio.Event] = None
+
+def _log(session: Session, msg: Union[str, bytes], tag: str = "INFO"):
+    # raw tool output may be passed as bytes; it is decoded in the writer thread
+    _LOG_QUEUE.append((session.user_id, tag, msg))
+
+def _write_logs_batched(batch: List[Tuple[int, str, Union[str, bytes]]]):
+    # runs in a worker thread: one open/write/close per user per batch
+    per_user: Dict[int, List[str]] = {}
+    for user_id, tag, msg in batch:
+        if isinstance(msg, bytes):
+            msg = msg.decode(errors="replace")
+        per_user.setdefault(user_id, []).append(f"[{tag}] {msg}\n")
+    for user_id, entries in per_user.items():
+        try:
+            path = os.path.join(LOG_DIR, f"{user_id}.log")
+            with open(path, "a", encoding="utf-8") as f:
+                f.write("".join(entries))
+        except Exception:
+            pass
 
-def main_bot_kb() -> InlineKeyboardMarkup:
-    kb = [
-        [InlineKeyboardButton("▶️ Jalankan Tools", callback_data="bot_run")],
-        [InlineKeyboardButton("ℹ️ Status Session", callback_data="bot_status")],
-        [
-            InlineKeyboardButton("📋 List Sessions", callback_data="bot_list"),
-            InlineKeyboardButton("🛑 Stop", callback_data="bot_stop"),
-            InlineKeyboardButton("♻️ Reset Session", callback_data="bot_reset"),
-        ],
-    ]
-    return InlineKeyboardMarkup(kb)
+def _take_logs() -> List[Tuple[int, str, Union[str, bytes]]]:
+    batch = list(_LOG_QUEUE)
+    _LOG_QUEUE.clear()
+    return batch
+
+async def _log_drainer(stop: asyncio.Event):
+    # the only log writer, final drain included, so batches never overlap or reorder
+    while True:
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=LOG_DRAIN_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        batch = _take_logs()
+        if batch:
+            await asyncio.to_thread(_write_logs_batched, batch)
+        if stop.is_set() and not _LOG_QUEUE:
+            return
 
+# stateless, so built once (PTB objects are immutable and safe to share)
+MAIN_BOT_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("▶️ Jalankan Tools", callback_data="bot_run")],
+    [InlineKeyboardButton("ℹ️ Status Session", callback_data="bot_status")],
+    [
+        InlineKeyboardButton("📋 List Sessions", callback_data="bot_list"),
+        InlineKeyboardButton("🛑 Stop", callback_data="bot_stop"),
+        InlineKeyboardButton("♻️ Reset Session", callback_data="bot_reset"),
+    ],
+])
+
+@lru_cache(maxsize=256)
 def normalize_choice(num: str) -> str:
     """
     Normalize choice for callback/send:
@@ -127,12 +203,15 @@ def normalize_choice(num: str) -> str:
     return n
 
 def menu_kb_from_items(items: List[Tuple[str, str]]) -> InlineKeyboardMarkup:
-    buttons = []
-    for num, label in items:
-        display_num = normalize_choice(num)  # show normalized to avoid confusion
-        txt = f"{display_num}. {label if len(label) <= 28 else label[:25] + '...'}"
-        cb = f"menu_choice|{normalize_choice(num)}"
-        buttons.append(InlineKeyboardButton(txt, callback_data=cb))
+    # display number is normalized (01 -> 1) to match what the callback sends
+    buttons = [
+        InlineKeyboardButton(
+            f"{dn}. {label if len(label) <= LABEL_CAP else label[:LABEL_TRUNC] + '...'}",
+            callback_data=f"menu_choice|{dn}",
+        )
+        for num, label in items
+        if (dn := normalize_choice(num))
+    ]
     rows = [buttons[i:i+2] for i in range(0, len(buttons), 2)]
     back_num = find_back_num(items)
     rows.append([
@@ -142,43 +221,49 @@ def menu_kb_from_items(items: List[Tuple[str, str]]) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(rows)
 
 def find_back_num(menu_items: List[Tuple[str, str]]) -> str:
+    # priority: back-like label > first "00"/"0" > first "99" > first item
+    zero = nine = None
     for num, label in menu_items:
-        if "kemb" in label.lower() or "kembali" in label.lower() or "utama" in label.lower() or "back" in label.lower():
-            return num
-    for num, _ in menu_items:
-        if num in ("00", "0"):
-            return num
-    for num, _ in menu_items:
-        if num == "99":
+        if BACK_LABEL_RE.search(label):
             return num
-    return menu_items[0][0] if menu_items else "99"
+        if zero is None and num in ("00", "0"):
+            zero = num
+        elif nine is None and num == "99":
+            nine = num
+    return zero or nine or (menu_items[0][0] if menu_items else "99")
 
 async def send_long_message(bot, chat_id: int, text: str, reply_markup=None):
     if not text:
         return
+    # encode once, split by byte offsets, decode only each chunk
+    data = text.encode("utf-8")
+    view = memoryview(data)
     start = 0
-    l = len(text)
-    first = True
+    l = len(data)
     while start < l:
-        end = min(l, start + TG_MAX)
+        end = min(l, start + TG_MAX_BYTES)
         if end < l:
-            nl = text.rfind("\n", start, end)
+            nl = data.rfind(b"\n", start, end)
             if nl != -1 and nl > start:
                 end = nl + 1
-        chunk = text[start:end]
+            else:
+                # no newline to split on: don't cut inside a multi-byte character
+                while end > start + 1 and (data[end] & 0xC0) == 0x80:
+                    end -= 1
+        chunk = str(view[start:end], "utf-8", "replace")
+        start = end
         try:
-            if first and reply_markup:
+            # keyboard goes on the last chunk, right under the text it belongs to
+            if start >= l and reply_markup:
                 await bot.send_message(chat_id=chat_id, text=chunk, reply_markup=reply_markup)
-                first = False
             else:
                 await bot.send_message(chat_id=chat_id, text=chunk)
         except Exception:
             # ignore send errors (best effort)
             pass
-        start = end
 
 # -------------------------
-# Subprocess env helper
+# Subprocess env & input helpers
 # -------------------------
 def build_subprocess_env():
     env = os.environ.copy()
@@ -213,17 +298,27 @@ def build_subprocess_env():
         pass
     return env
 
+async def _write_input(session: Session, text: str):
+    # text + newline handed to the transport together -> one write
+    session.stdin_writer.writelines((text.encode(), b"\n"))
+    await session.stdin_writer.drain()
+
 # -------------------------
 # Subprocess lifecycle
 # -------------------------
 async def start_tool(session: Session, context: ContextTypes.DEFAULT_TYPE):
     async with session.lock:
         if session.is_running():
-            await context.bot.send_message(chat_id=session.chat_id, text="⚠️ Tool sudah berjalan.", reply_markup=main_bot_kb())
+            await context.bot.send_message(chat_id=session.chat_id, text="⚠️ Tool sudah berjalan.", reply_markup=MAIN_BOT_KB)
             return
         if not os.path.isfile(TOOLS_FILE):
-            await context.bot.send_message(chat_id=session.chat_id, text=f"❌ File tool tidak ditemukan: {TOOLS_FILE}", reply_markup=main_bot_kb())
+            await context.bot.send_message(chat_id=session.chat_id, text=f"❌ File tool tidak ditemukan: {TOOLS_FILE}", reply_markup=MAIN_BOT_KB)
             return
+        # previous run ended on its own: let its sender deliver the final flush
+        # (it exits on the reader's None sentinel); only still-live tasks get cancelled
+        if session.reader_task and session.reader_task.done() and session.sender_task:
+            await asyncio.gather(session.sender_task, return_exceptions=True)
+        await _cancel_tasks(session)
         python = sys.executable or "python3"
         env = build_subprocess_env()
         try:
@@ -234,29 +329,30 @@ async def start_tool(session: Session, context: ContextTypes.DEFAULT_TYPE):
                 stderr=asyncio.subprocess.STDOUT,
                 cwd=TOOLS_DIR if TOOLS_DIR else None,
                 env=env,
+                limit=STDOUT_LIMIT,
             )
         except Exception as e:
-            await context.bot.send_message(chat_id=session.chat_id, text=f"❌ Gagal menjalankan tool: {e}", reply_markup=main_bot_kb())
+            await context.bot.send_message(chat_id=session.chat_id, text=f"❌ Gagal menjalankan tool: {e}", reply_markup=MAIN_BOT_KB)
             return
 
         session.stdin_writer = session.proc.stdin
-        session.partial = ""
-        session.buffer_lines.clear()
+        session._now = asyncio.get_running_loop().time
+        session.buffer.clear()
         session.menu_items.clear()
-        session.last_output_time = asyncio.get_event_loop().time()
         session.awaiting_input = False
         session.last_prompt_time = None
         session.input_prompt_text = None
 
+        session.send_queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        session.sender_task = asyncio.create_task(_sender_loop(session, context))
         session.reader_task = asyncio.create_task(_reader_loop(session, context))
-        session.flusher_task = asyncio.create_task(_flusher_loop(session, context))
 
-        await context.bot.send_message(chat_id=session.chat_id, text=f"▶️ Tool dijalankan (PID {getattr(session.proc,'pid','?')})", reply_markup=main_bot_kb())
+        await context.bot.send_message(chat_id=session.chat_id, text=f"▶️ Tool dijalankan (PID {getattr(session.proc,'pid','?')})", reply_markup=MAIN_BOT_KB)
 
 async def stop_tool(session: Session, context: ContextTypes.DEFAULT_TYPE):
     async with session.lock:
         if not session.is_running():
-            await context.bot.send_message(chat_id=session.chat_id, text="ℹ️ Tidak ada tool berjalan.", reply_markup=main_bot_kb())
+            await context.bot.send_message(chat_id=session.chat_id, text="ℹ️ Tidak ada tool berjalan.", reply_markup=MAIN_BOT_KB)
             return
         try:
             session.proc.terminate()
@@ -268,27 +364,29 @@ async def stop_tool(session: Session, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             pass
         await _cancel_tasks(session)
-        await context.bot.send_message(chat_id=session.chat_id, text="🛑 Tool dihentikan.", reply_markup=main_bot_kb())
+        await context.bot.send_message(chat_id=session.chat_id, text="🛑 Tool dihentikan.", reply_markup=MAIN_BOT_KB)
 
 async def reset_session(session: Session, context: ContextTypes.DEFAULT_TYPE):
     await stop_tool(session, context)
-    session.partial = ""
-    session.buffer_lines.clear()
+    session.buffer.clear()
     session.menu_items.clear()
     session.awaiting_input = False
     session.last_prompt_time = None
     session.input_prompt_text = None
-    await context.bot.send_message(chat_id=session.chat_id, text="♻️ Session di-reset.", reply_markup=main_bot_kb())
+    await context.bot.send_message(chat_id=session.chat_id, text="♻️ Session di-reset.", reply_markup=MAIN_BOT_KB)
 
 async def _cancel_tasks(session: Session):
-    for t in (session.reader_task, session.flusher_task):
-        if t:
-            try:
-                t.cancel()
-            except Exception:
-                pass
+    if session.flush_handle:
+        session.flush_handle.cancel()
+    tasks = [t for t in (session.reader_task, session.sender_task, session.flush_task) if t]
+    for t in tasks:
+        t.cancel()
+    # wait until they are really finished, so a new run never races a stale reader/sender
+    await asyncio.gather(*tasks, return_exceptions=True)
     session.reader_task = None
-    session.flusher_task = None
+    session.sender_task = None
+    session.flush_task = None
+    session.flush_handle = None
     session.proc = None
     session.stdin_writer = None
 
@@ -298,47 +396,65 @@ async def _cancel_tasks(session: Session):
 async def _reader_loop(session: Session, context: ContextTypes.DEFAULT_TYPE):
     try:
         reader = session.proc.stdout
+        loop = asyncio.get_running_loop()
+        # unterminated output carried between reads; each byte is scanned a bounded number of times
+        tail = bytearray()
         while True:
-            data = await reader.read(1024)
+            data = await reader.read(READ_CHUNK)
             if not data:
                 break
-            s = data.decode(errors="replace")
-            session.partial += s
-            session.last_output_time = asyncio.get_event_loop().time()
+            # only new bytes can contain a newline
+            scan = len(tail)
+            tail += data
 
             # process full lines
-            while "\n" in session.partial:
-                line, session.partial = session.partial.split("\n", 1)
-                await _process_line(session, line.rstrip("\r"), is_partial=False)
-
-            # check partial for prompt-like content (no newline)
-            p = session.partial.strip()
-            if p:
-                if ENDS_WITH_COLON_RE.match(p) or PROMPT_KEYWORDS_RE.search(p) or ONLY_DIGITS_RE.match(p):
-                    await _process_line(session, p, is_partial=True)
-                    session.partial = ""
+            start = 0
+            with memoryview(tail) as view:
+                while (nl := tail.find(b"\n", scan)) != -1:
+                    await _process_line(session, context, view[start:nl].tobytes().rstrip(b"\r"), is_partial=False)
+                    start = scan = nl + 1
+            if start:
+                del tail[:start]
+
+            # check leftover for prompt-like content (no newline): only the last
+            # PROMPT_TAIL_MAX bytes after the last \r, so progress bars stay cheap
+            seg = tail[-PROMPT_TAIL_MAX:]
+            seg = seg[seg.rfind(b"\r") + 1:].strip()
+            if seg and _looks_like_prompt(seg):
+                await _process_line(session, context, bytes(tail).strip(), is_partial=True)
+                tail.clear()
+            elif len(tail) >= STDOUT_LIMIT:
+                # overlong line without newline: pass it on instead of growing tail
+                await _process_line(session, context, bytes(tail), is_partial=False)
+                tail.clear()
+
+            # (re)arm idle flush once per read, not per line
+            if session.buffer or session.menu_items:
+                _schedule_flush(session, context, loop)
         # EOF leftover
-        if session.partial:
-            await _process_line(session, session.partial.rstrip("\r\n"), is_partial=True)
-            session.partial = ""
-        # final flush
-        await _flush_buffer_and_menu(session, context)
-        # notify completion
-        await send_long_message(context.bot, session.chat_id, "🔚 Proses tool selesai.", reply_markup=main_bot_kb())
+        if tail:
+            await _process_line(session, context, bytes(tail).rstrip(b"\r\n"), is_partial=True)
+        if session.flush_handle:
+            session.flush_handle.cancel()
+            session.flush_handle = None
+        # final flush + completion notice in one send
+        await _flush_buffer_and_menu(session, context, trailer="🔚 Proses tool selesai.", trailer_kb=MAIN_BOT_KB)
     except asyncio.CancelledError:
         return
     except Exception as e:
-        try:
-            await send_long_message(context.bot, session.chat_id, f"⚠️ Reader error: {e}", reply_markup=main_bot_kb())
-        except Exception:
-            pass
+        await session.send_queue.put((f"⚠️ Reader error: {e}", MAIN_BOT_KB))
+    # let sender drain what is queued, then exit
+    await session.send_queue.put(None)
+
+def _looks_like_prompt(raw: bytes) -> bool:
+    # three separate patterns short-circuited: measured faster than one merged alternation
+    return bool(ENDS_WITH_COLON_RE.match(raw) or PROMPT_KEYWORDS_RE.search(raw) or ONLY_DIGITS_RE.match(raw))
 
-async def _process_line(session: Session, line: str, is_partial: bool = False):
-    if not line:
+async def _process_line(session: Session, context: ContextTypes.DEFAULT_TYPE, raw: bytes, is_partial: bool = False):
+    if not raw:
         return
 
-    low = line.lower()
-    if "press enter to continue" in low or "press any key to continue" in low:
+    if AUTO_ENTER_RE.search(raw):
         # auto-send newline to let tool continue
         if session.stdin_writer:
             try:
@@ -349,65 +465,85 @@ async def _process_line(session: Session, line: str, is_partial: bool = False):
                 pass
         return
 
-    m = MENU_ITEM_RE.match(line)
+    m = MENU_ITEM_RE.match(raw)
     if m:
-        num = m.group(1).strip()
-        label = m.group(2).strip()
+        num = m.group(1).strip().decode()
+        label = m.group(2).strip().decode(errors="replace")
         session.menu_items.append((num, label))
         _log(session, f"MENU {num} -> {label}", "OUT")
         return
 
-    session.buffer_lines.append(line)
-    session.last_output_time = asyncio.get_event_loop().time()
-    _log(session, line, "OUT")
+    session.buffer += raw
+    session.buffer += b"\n"
+    _log(session, raw, "OUT")
 
     # detect prompt-like content (including partials)
-    is_prompt = is_partial or ENDS_WITH_COLON_RE.match(line) or PROMPT_KEYWORDS_RE.search(line) or ONLY_DIGITS_RE.match(line)
+    is_prompt = is_partial or _looks_like_prompt(raw)
     if is_prompt:
+        line = raw.decode(errors="replace")
         session.awaiting_input = True
-        session.last_prompt_time = asyncio.get_event_loop().time()
+        session.last_prompt_time = session._now()
         session.input_prompt_text = line
         _log(session, f"PROMPT detected: {line}", "PROMPT")
-        # do not flush here — flusher will send combined message after idle
+        # do not flush here — idle timer will send combined message
 
 # -------------------------
-# Flusher
+# Flusher & sender
 # -------------------------
-async def _flusher_loop(session: Session, context: ContextTypes.DEFAULT_TYPE):
+def _schedule_flush(session: Session, context: ContextTypes.DEFAULT_TYPE, loop: asyncio.AbstractEventLoop):
+    # (re)arm idle timer: flush fires BUFFER_FLUSH_IDLE seconds after the last output
+    if session.flush_handle:
+        session.flush_handle.cancel()
+    session.flush_handle = loop.call_later(BUFFER_FLUSH_IDLE, _start_flush, session, context)
+
+def _start_flush(session: Session, context: ContextTypes.DEFAULT_TYPE):
+    # timer callback; task is kept on the session so it is not an unreferenced create_task
+    session.flush_handle = None
+    session.flush_task = asyncio.create_task(_flush_buffer_and_menu(session, context))
+
+async def _flush_buffer_and_menu(session: Session, context: ContextTypes.DEFAULT_TYPE, trailer: str = "", trailer_kb=None):
+    """
+    Queue buffered output (+ menu) as one message for the sender.
+    - trailer: optional text appended to the same message (e.g. completion notice)
+    - trailer_kb: keyboard used instead of the menu keyboard when trailer is given
+    """
+    # buffers are swapped out before the first await, so concurrent flushes never overlap
+    buf, session.buffer = session.buffer, bytearray()
+    menu, session.menu_items = session.menu_items, []
+
+    text = buf.decode(errors="replace").strip()
+    if menu:
+        menu_text = "\n".join([f"{n}. {l}" for n, l in menu])
+        if text:
+            full = text + "\n\n📋 Menu:\n" + menu_text
+        else:
+            full = "📋 Menu:\n" + menu_text
+        kb = menu_kb_from_items(menu)
+        tag = "menu"
+    else:
+        full = text
+        kb = None
+        tag = "text"
+    if trailer:
+        # tool is gone at this point, so menu buttons are useless — use trailer keyboard
+        full = full + "\n\n" + trailer if full else trailer
+        kb = trailer_kb
+    if full:
+        await session.send_queue.put((full, kb))
+        _log(session, f"SENT combined ({tag}) len={len(full)}", "SEND")
+
+async def _sender_loop(session: Session, context: ContextTypes.DEFAULT_TYPE):
+    # single consumer per session keeps message order; None ends the loop
     try:
         while True:
-            await asyncio.sleep(0.5)
-            if session.buffer_lines or session.menu_items:
-                idle = asyncio.get_event_loop().time() - session.last_output_time
-                if idle >= BUFFER_FLUSH_IDLE:
-                    await _flush_buffer_and_menu(session, context)
+            payload = await session.send_queue.get()
+            if payload is None:
+                return
+            text, kb = payload
+            await send_long_message(context.bot, session.chat_id, text, reply_markup=kb)
     except asyncio.CancelledError:
         return
 
-async def _flush_buffer_and_menu(session: Session, context: ContextTypes.DEFAULT_TYPE):
-    async with session.send_lock:
-        if not session.buffer_lines and not session.menu_items:
-            return
-        lines = session.buffer_lines.copy()
-        session.buffer_lines.clear()
-        menu = session.menu_items.copy()
-        session.menu_items.clear()
-
-        text = "\n".join(lines).strip()
-        if menu:
-            menu_text = "\n".join([f"{n}. {l}" for n, l in menu])
-            if text:
-                full = text + "\n\n📋 Menu:\n" + menu_text
-            else:
-                full = "📋 Menu:\n" + menu_text
-            kb = menu_kb_from_items(menu)
-            await send_long_message(context.bot, session.chat_id, full, reply_markup=kb)
-            _log(session, f"SENT combined (menu) len={len(full)}", "SEND")
-        else:
-            if text:
-                await send_long_message(context.bot, session.chat_id, text, reply_markup=None)
-                _log(session, f"SENT combined text len={len(text)}", "SEND")
-
 # -------------------------
 # Callbacks & message handlers
 # -------------------------
@@ -418,7 +554,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await q.answer()  # no popup text, just acknowledge
     user = update.effective_user
     chat_id = update.effective_chat.id
-    s = SESSIONS.setdefault(user.id, Session(user_id=user.id, chat_id=chat_id))
+    s = get_session(user.id, chat_id)
     data = q.data
 
     # Bot-level commands
@@ -434,14 +570,21 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "bot_status":
         info = f"Status:\n- Running: {s.is_running()}\n- Awaiting input: {s.awaiting_input}"
         try:
-            await q.edit_message_text(info, reply_markup=main_bot_kb())
+            await q.edit_message_text(info, reply_markup=MAIN_BOT_KB)
         except Exception:
             pass
         return
     if data == "bot_list":
-        parts = [f"{uid} – running={ss.is_running()}" for uid, ss in SESSIONS.items()]
+        global _list_cache
+        now = asyncio.get_running_loop().time()
+        if now - _list_cache[0] < LIST_CACHE_TTL:
+            txt = _list_cache[1]
+        else:
+            parts = [f"{uid} – running={ss.is_running()}" for uid, ss in SESSIONS.items()]
+            txt = "📋 Sessions:\n" + ("\n".join(parts) if parts else "Tidak ada session")
+            _list_cache = (now, txt)
         try:
-            await q.edit_message_text("📋 Sessions:\n" + ("\n".join(parts) if parts else "Tidak ada session"), reply_markup=main_bot_kb())
+            await q.edit_message_text(txt, reply_markup=MAIN_BOT_KB)
         except Exception:
             pass
         return
@@ -451,8 +594,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         num = data.split("|", 1)[1]
         if s.is_running() and s.stdin_writer:
             try:
-                s.stdin_writer.write((num + "\n").encode())
-                await s.stdin_writer.drain()
+                await _write_input(s, num)
                 s.awaiting_input = False
                 s.last_prompt_time = None
                 s.input_prompt_text = None
@@ -466,8 +608,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         back_num = data.split("|", 1)[1]
         if s.is_running() and s.stdin_writer:
             try:
-                s.stdin_writer.write((back_num + "\n").encode())
-                await s.stdin_writer.drain()
+                await _write_input(s, back_num)
                 s.awaiting_input = False
                 s.last_prompt_time = None
                 s.input_prompt_text = None
@@ -479,7 +620,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # cancel
     if data == "menu_cancel":
         try:
-            await q.edit_message_text("❌ Menu ditutup.", reply_markup=main_bot_kb())
+            await q.edit_message_text("❌ Menu ditutup.", reply_markup=MAIN_BOT_KB)
         except Exception:
             pass
         s.menu_items.clear()
@@ -491,12 +632,11 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     chat_id = update.effective_chat.id
     text = (update.message.text or "").strip()
-    s = SESSIONS.setdefault(user.id, Session(user_id=user.id, chat_id=chat_id))
+    s = get_session(user.id, chat_id)
 
     if s.is_running() and s.stdin_writer:
         try:
-            s.stdin_writer.write((text + "\n").encode())
-            await s.stdin_writer.drain()
+            await _write_input(s, text)
             s.awaiting_input = False
             s.last_prompt_time = None
             s.input_prompt_text = None
@@ -505,28 +645,73 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             # if sending fails, notify user minimally
             try:
-                await update.message.reply_text("❌ Gagal mengirim input ke tool.", reply_markup=main_bot_kb())
+                await update.message.reply_text("❌ Gagal mengirim input ke tool.", reply_markup=MAIN_BOT_KB)
             except Exception:
                 pass
     else:
-        await update.message.reply_text("❌ Tool belum berjalan. Tekan ▶️ Jalankan Tools.", reply_markup=main_bot_kb())
+        await update.message.reply_text("❌ Tool belum berjalan. Tekan ▶️ Jalankan Tools.", reply_markup=MAIN_BOT_KB)
 
 # start command
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    SESSIONS.setdefault(user.id, Session(user_id=user.id, chat_id=update.effective_chat.id))
-    await update.message.reply_text("🚀 Selamat datang di KACER BOT — gunakan tombol untuk memulai.", reply_markup=main_bot_kb())
+    get_session(user.id, update.effective_chat.id)
+    await update.message.reply_text("🚀 Selamat datang di KACER BOT — gunakan tombol untuk memulai.", reply_markup=MAIN_BOT_KB)
 
 # -------------------------
 # Entrypoint
 # -------------------------
+async def _start_log_drainer():
+    global _log_task, _log_stop
+    _log_stop = asyncio.Event()
+    _log_task = asyncio.create_task(_log_drainer(_log_stop))
+
+async def _stop_log_drainer():
+    # no cancel: let the drainer finish its in-flight batch and write what is still pending
+    if _log_task:
+        _log_stop.set()
+        await _log_task
+
+async def _graceful_shutdown(app: Application):
+    # stop every running tool so no orphaned main.py outlives the bot
+    context = CallbackContext(app)
+    await asyncio.gather(
+        *[asyncio.wait_for(stop_tool(s, context), SHUTDOWN_STOP_TIMEOUT) for s in SESSIONS.values() if s.is_running()],
+        return_exceptions=True,
+    )
+
+async def _run(app: Application):
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await _start_log_drainer()
+    async with app:  # initialize / shutdown
+        await app.start()
+        await app.updater.start_polling(allowed_updates=["message", "callback_query"])
+        try:
+            await stop_event.wait()
+        finally:
+            # stop taking updates first, then drain tools, then stop the app
+            await app.updater.stop()
+            await _graceful_shutdown(app)
+            await app.stop()
+    await _stop_log_drainer()
+
 def main():
     app = Application.builder().token(BOT_TOKEN).build()
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CallbackQueryHandler(callback_handler))
     app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), text_handler))
 
-    app.run_polling(allowed_updates=["message", "callback_query"], stop_signals=(signal.SIGINT, signal.SIGTERM))
+    # optional faster event loop (uvloop.run, no policy API); falls back to asyncio.run
+    # when uvloop is missing or too old (< 0.18 has no run())
+    try:
+        import uvloop
+    except ImportError:
+        uvloop = None
+    runner = getattr(uvloop, "run", None) or asyncio.run
+    runner(_run(app))
 
 if __name__ == "__main__":
     main()